@@ -1,16 +1,23 @@
 # app.py
 import os
-import json
-from typing import Optional, List, Dict
-from urllib.parse import urlparse
+import heapq
+import asyncio
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from itertools import chain
+from typing import Optional, List, Dict, Tuple
 
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+import ahocorasick
+import httpx
+import orjson
+from anyio import to_thread
+from cachetools import TTLCache
 
 
 from fastapi import FastAPI, HTTPException, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
 # ==== 環境変数 ====
@@ -18,20 +25,45 @@ APPLICATION_ID = os.environ.get("RAKUTEN_APPLICATION_ID")
 AFFILIATE_ID = os.environ.get("RAKUTEN_AFFILIATE_ID")
 API_BEARER_TOKEN = os.environ.get("GPTS_ACTIONS_BEARER")  # 任意: GPTsのActionsに同値を設定
 RAKUTEN_URL = "https://app.rakuten.co.jp/services/api/IchibaItem/Search/20220601"
+THREADPOOL_TOKENS = int(os.environ.get("THREADPOOL_TOKENS", "200"))
 
-# ==== HTTPセッション（簡易リトライ付き） ====
-session = requests.Session()
-retries = Retry(
-    total=3,
-    backoff_factor=0.5,
-    status_forcelist=(429, 500, 502, 503, 504),
-    allowed_methods=frozenset(["GET"])
+# ==== HTTPクライアント（非同期・コネクションプール・簡易リトライ付き） ====
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_FORCELIST = frozenset([429, 500, 502, 503, 504])
+
+# プールはキーワードの同時検索数より十分大きくし、常に keep-alive 済みの接続を再利用する
+client = httpx.AsyncClient(
+    timeout=10,
+    limits=httpx.Limits(
+        max_connections=32,
+        max_keepalive_connections=32,
+        keepalive_expiry=60,
+    ),
+    headers={"Accept-Encoding": "gzip"},
+    http2=True,
 )
-session.mount("https://", HTTPAdapter(max_retries=retries))
-session.mount("http://", HTTPAdapter(max_retries=retries))
+
+# ==== 検索結果キャッシュ（キーワード単位・1時間） ====
+# 汎用キーワードはほぼ毎リクエストで同じなので、楽天への問い合わせを大幅に削減できる
+_search_cache: TTLCache = TTLCache(maxsize=512, ttl=3600)
+
+async def _get_with_retry(url: str, params: Dict) -> httpx.Response:
+    """GETを指数バックオフ付きでリトライ（旧 urllib3 Retry 相当）。"""
+    for attempt in range(RETRY_TOTAL + 1):
+        try:
+            r = await client.get(url, params=params)
+        except httpx.TransportError:
+            if attempt == RETRY_TOTAL:
+                raise
+        else:
+            if r.status_code not in RETRY_STATUS_FORCELIST or attempt == RETRY_TOTAL:
+                return r
+        await asyncio.sleep(RETRY_BACKOFF_FACTOR * (2 ** attempt))
 
 # ==== 認証（Bearer） ====
-def auth_dependency(authorization: Optional[str] = Header(None)):
+# I/Oを伴わないので async にしてスレッドプールを経由させない
+async def auth_dependency(authorization: Optional[str] = Header(None)):
     if not API_BEARER_TOKEN:
         # トークン未設定ならチェックしない（必要なら必須化しても良い）
         return
@@ -42,7 +74,19 @@ def auth_dependency(authorization: Optional[str] = Header(None)):
         raise HTTPException(status_code=403, detail="Forbidden")
 
 # ==== FastAPI アプリ本体 ====
-app = FastAPI(title="Recipe Cooking Tools Recommendation Functions")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 同期ハンドラ/依存関係用スレッドプールの上限を拡張（既定は40）
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_TOKENS
+    yield
+    # 終了時にコネクションプールを閉じる
+    await client.aclose()
+
+app = FastAPI(
+    title="Recipe Cooking Tools Recommendation Functions",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # ヘルスチェック（Render推奨）
 @app.get("/")
@@ -58,59 +102,87 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ==== レスポンス圧縮（HTML＋商品一覧は圧縮が効きやすい） ====
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 # ==== ユーティリティ ====
+_ALLOW_HOSTS = frozenset({
+    "item.rakuten.co.jp",
+    "books.rakuten.co.jp",
+    "hb.afl.rakuten.co.jp",
+    "afl.rakuten.co.jp",
+    "www.rakuten.co.jp"
+})
+
 def _sanitize_url(url: str) -> Optional[str]:
     """アフィリエイトURLを安全側で許可。"""
-    try:
-        if not url:
-            return None
-        u = urlparse(url)
-        allow_hosts = {
-            "item.rakuten.co.jp",
-            "books.rakuten.co.jp",
-            "hb.afl.rakuten.co.jp",
-            "afl.rakuten.co.jp",
-            "www.rakuten.co.jp"
-        }
-        if u.scheme in {"http", "https"} and u.netloc in allow_hosts:
-            return url
-    except Exception:
-        pass
-    return None
+    if not url:
+        return None
+    if url.startswith("https://"):
+        rest = url[8:]
+    elif url.startswith("http://"):
+        rest = url[7:]
+    else:
+        return None
+    host = rest.split("/", 1)[0]
+    return url if host in _ALLOW_HOSTS else None
 
-def _extract_keywords_from_recipe(recipe_text: str) -> List[str]:
+# ==== レシピ → 検索キーワード対応表 ====
+# (レシピ中の語, 追加する検索キーワード) の組。上から順に検索キーワードへ展開する
+_KEYWORD_RULES = (
+    (("レンジ", "電子レンジ", "レンチン"), ("電子レンジ調理器", "耐熱容器", "レンジ対応")),
+    (("ゆで卵", "ゆでたまご"), ("ゆで卵メーカー",)),
+    (("蒸し", "蒸す"), ("スチーマー",)),
+    (("焼き", "焼く"), ("グリルパン",)),
+    (("煮物", "煮る"), ("耐熱ボウル",)),
+    (("ごはん", "ご飯"), ("冷凍ごはん容器",)),
+)
+# 毎回付与する汎用キーワードは OR 検索1回にまとめ、件数を増やして取得する
+_GENERIC_QUERY = "調理器具 キッチン用品 保存容器"
+_QUERY_PARAM_OVERRIDES = {
+    _GENERIC_QUERY: {"orFlag": 1, "hits": 30},
+}
+
+# 全トリガー語を1つのオートマトンにまとめ、レシピ本文を1回の走査で照合する
+_keyword_automaton = ahocorasick.Automaton()
+for _idx, (_triggers, _) in enumerate(_KEYWORD_RULES):
+    for _trigger in _triggers:
+        _keyword_automaton.add_word(_trigger, _idx)
+_keyword_automaton.make_automaton()
+
+@lru_cache(maxsize=256)
+def _extract_keywords_from_recipe(recipe_text: str) -> Tuple[str, ...]:
+    hits = {idx for _, idx in _keyword_automaton.iter(recipe_text)}
     kws: List[str] = []
-    if any(k in recipe_text for k in ["レンジ", "電子レンジ", "レンチン"]):
-        kws.extend(["電子レンジ調理器", "耐熱容器", "レンジ対応"])
-    if any(k in recipe_text for k in ["ゆで卵", "ゆでたまご"]):
-        kws.append("ゆで卵メーカー")
-    if any(k in recipe_text for k in ["蒸し", "蒸す"]):
-        kws.append("スチーマー")
-    if any(k in recipe_text for k in ["焼き", "焼く"]):
-        kws.append("グリルパン")
-    if any(k in recipe_text for k in ["煮物", "煮る"]):
-        kws.append("耐熱ボウル")
-    if any(k in recipe_text for k in ["ごはん", "ご飯"]):
-        kws.append("冷凍ごはん容器")
-    kws.extend(["調理器具", "キッチン用品", "保存容器"])
-    return list({k for k in kws})
-
-def _search_rakuten_products(keyword: str) -> List[Dict]:
+    for idx in sorted(hits):
+        kws.extend(_KEYWORD_RULES[idx][1])
+    kws.append(_GENERIC_QUERY)
+    return tuple(dict.fromkeys(kws))
+
+# キーワード以外は固定なので起動時に1度だけ組み立てる
+_BASE_PARAMS = {
+    "applicationId": APPLICATION_ID,
+    "affiliateId": AFFILIATE_ID,
+    "format": "json",
+    "sort": "-reviewAverage",
+    "hits": 10,
+    "minReviewAverage": 4.0
+}
+
+async def _search_rakuten_products(keyword: str) -> List[Dict]:
     if not APPLICATION_ID or not AFFILIATE_ID:
         return []
-    params = {
-        "applicationId": APPLICATION_ID,
-        "affiliateId": AFFILIATE_ID,
-        "keyword": keyword,
-        "format": "json",
-        "sort": "-reviewAverage",
-        "hits": 10,
-        "minReviewAverage": 4.0
-    }
+    cached = _search_cache.get(keyword)
+    if cached is not None:
+        return cached
+    params = {**_BASE_PARAMS, "keyword": keyword}
+    overrides = _QUERY_PARAM_OVERRIDES.get(keyword)
+    if overrides:
+        params.update(overrides)
     try:
-        r = session.get(RAKUTEN_URL, params=params, timeout=10)
+        r = await _get_with_retry(RAKUTEN_URL, params)
         r.raise_for_status()
-        data = r.json()
+        data = orjson.loads(r.content)
         items = data.get("Items", [])
         products: List[Dict] = []
         for it in items:
@@ -130,14 +202,13 @@ def _search_rakuten_products(keyword: str) -> List[Dict]:
             }
             if prod.get("name"):
                 products.append(prod)
+        _search_cache[keyword] = products
         return products
     except Exception:
         return []
 
-def _generate_recommendation_html(products: List[Dict], title: str) -> str:
-    if not products:
-        return "<p>おすすめの料理グッズは見つかりませんでした。</p>"
-    html = f"""
+# ==== おすすめHTMLのテンプレート ====
+_HEADER_TMPL = """
 <div class="product-recommendations" role="region" aria-label="レンチン調理器具のおすすめ一覧">
   <h2>【PR】🍳 {title}におすすめの料理グッズ</h2>
   <p class="disclosure">
@@ -145,33 +216,26 @@ def _generate_recommendation_html(products: List[Dict], title: str) -> str:
   </p>
   <div class="products-grid">
 """
-    for i, p in enumerate(products):
-        safe_url = _sanitize_url(p.get("affiliate_url") or "")
-        href = safe_url or "#"
-        rel_attr = "sponsored noopener noreferrer" if safe_url else "noopener noreferrer nofollow"
-        name = p.get("name", "")
-        price = p.get("price") or 0
-        rating = p.get("review_average", "-")
-        rcount = p.get("review_count", "-")
-        html += f"""
+
+# 商品カードは件数分くり返し使うので、位置引数の % 書式で埋め込む
+# (順位, 商品名, 価格, 評価, 件数, URL, rel, 商品名)
+_CARD_TMPL = """
     <div class="product-card">
-      <div class="product-rank">#{i+1}</div>
+      <div class="product-rank">#%d</div>
       <div class="product-info">
-        <h3 class="product-name">{name}</h3>
+        <h3 class="product-name">%s</h3>
         <div class="product-details">
-          <span class="price">¥{price:,}</span>
-          <span class="rating">⭐ {rating} ({rcount}件)</span>
+          <span class="price">¥%s</span>
+          <span class="rating">⭐ %s (%s件)</span>
         </div>
-        <a href="{href}" target="_blank" rel="{rel_attr}" class="affiliate-link" aria-label="楽天市場で詳細を見る：{name}">
+        <a href="%s" target="_blank" rel="%s" class="affiliate-link" aria-label="楽天市場で詳細を見る：%s">
           楽天市場で詳細を見る
         </a>
       </div>
     </div>
 """
-    html += """
-  </div>
-</div>
-<style>
+
+_STYLE_BLOCK = """<style>
 .product-recommendations{max-width:800px;margin:20px auto;padding:20px;font-family:Arial,sans-serif}
 .disclosure{font-size:12px;color:#666;margin:8px 0 0 0}
 .products-grid{display:grid;gap:15px;margin-top:16px}
@@ -186,9 +250,41 @@ def _generate_recommendation_html(products: List[Dict], title: str) -> str:
 .affiliate-link:hover{background:#219a52}
 </style>
 """
-    return html
 
-def recommendCookingTools(recipe_text: str, recipe_title: str = "レンチンレシピ"):
+_FOOTER = """
+  </div>
+</div>
+""" + _STYLE_BLOCK
+
+# HTML特殊文字のエスケープ表（str.translate で1パス置換）
+_ESC = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"})
+
+def _escape(value) -> str:
+    return str(value).translate(_ESC)
+
+def _generate_recommendation_html(products: List[Dict], title: str) -> str:
+    if not products:
+        return "<p>おすすめの料理グッズは見つかりませんでした。</p>"
+    parts = [_HEADER_TMPL.format(title=_escape(title))]
+    for i, p in enumerate(products):
+        safe_url = _sanitize_url(p.get("affiliate_url") or "")
+        href = safe_url or "#"
+        rel_attr = "sponsored noopener noreferrer" if safe_url else "noopener noreferrer nofollow"
+        name = _escape(p.get("name", ""))
+        parts.append(_CARD_TMPL % (
+            i + 1,
+            name,
+            format(p.get("price") or 0, ","),
+            _escape(p.get("review_average", "-")),
+            _escape(p.get("review_count", "-")),
+            _escape(href),
+            rel_attr,
+            name,
+        ))
+    parts.append(_FOOTER)
+    return "".join(parts)
+
+async def recommendCookingTools(recipe_text: str, recipe_title: str = "レンチンレシピ"):
     kws = _extract_keywords_from_recipe(recipe_text)
     if not kws:
         return {
@@ -198,23 +294,21 @@ def recommendCookingTools(recipe_text: str, recipe_title: str = "レンチンレ
             "html": "<p>レシピから関連キーワードを抽出できませんでした。</p>",
             "count": 0
         }
-    all_products: List[Dict] = []
-    for kw in kws:
-        all_products.extend(_search_rakuten_products(kw))
-
-    # 重複排除（先頭50文字）
-    uniq = {}
-    for p in all_products:
-        name = p.get("name")
-        if not name:
-            continue
-        key = name[:50]
-        if key not in uniq:
-            uniq[key] = p
-
-    products = list(uniq.values())
-    products.sort(key=lambda x: (x.get("review_average") or 0), reverse=True)
-    top10 = products[:10]
+    # 楽天APIへの問い合わせをイベントループ上で並行実行（gather は投入順に結果を返す）
+    results = await asyncio.gather(
+        *[_search_rakuten_products(kw) for kw in kws], return_exceptions=True
+    )
+
+    # 収集しながら重複排除（先頭50文字）
+    seen = set()
+    products: List[Dict] = []
+    for p in chain.from_iterable(r for r in results if not isinstance(r, BaseException)):
+        key = (p.get("name") or "")[:50]
+        if key and key not in seen:
+            seen.add(key)
+            products.append(p)
+
+    top10 = heapq.nlargest(10, products, key=lambda x: (x.get("review_average") or 0))
     html = _generate_recommendation_html(top10, recipe_title)
 
     return {
@@ -247,12 +341,15 @@ class Res(BaseModel):
     message: str
 
 # ==== エンドポイント ====
+# response_model は OpenAPI スキーマ（GPTs Actions 用）のためだけに残し、
+# Response を直接返すことで Pydantic による再検証・再シリアライズを省く
 @app.post("/recommend_cooking_tools", response_model=Res)
-def endpoint(body: Req, _=Depends(auth_dependency)):
+async def endpoint(body: Req, _=Depends(auth_dependency)):
     try:
         if not body.recipe_text or not body.recipe_text.strip():
             raise HTTPException(status_code=400, detail="recipe_text is required")
-        return recommendCookingTools(body.recipe_text, body.recipe_title or "レンチンレシピ")
+        result = await recommendCookingTools(body.recipe_text, body.recipe_title or "レンチンレシピ")
+        return ORJSONResponse(content=result)
     except HTTPException:
         raise
     except Exception as e: